@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 Atlantic.Net external inventory script
@@ -9,16 +9,18 @@ Generates Ansible inventory of Atlantic.Net Cloudservers.
 In addition to the --list and --host options used by Ansible, there are options
 for generating JSON of other Atlantic.Net data.  This is useful when creating
 cloudservers.  For example, --plans will return all the Atlantic.Net Plans.
-This information can also be easily found in the cache file, whose default
-location is /tmp/ansible-digital_ocean.cache).
+This information can also be easily found in the cache files, one per resource,
+whose default location is /tmp/ansible-atlantic_net/).
 
 The --pretty (-p) option pretty-prints the output for better human readability.
 
 ----
 Although the cache stores all the information received from Atlantic.Net,
-the cache is not used for current cloudserver information (in --list, --host,
---all, and --cloudservers).  This is so that accurate cloudserver information is always
-found.  You can force this script to use the cache with --force-cache.
+the cache is not used for current cloudserver information (in --all and
+--cloudservers).  This is so that accurate cloudserver information is always
+found.  You can force this script to use the cache with --force-cache.  While the
+cache is younger than cache_max_age, --list returns the cached inventory as-is and
+--host answers from the cached indices before making any API call.
 
 ----
 Configuration is read from `anet_inventory.ini`, then from environment variables,
@@ -46,7 +48,9 @@ The following groups are generated from --list:
  - plan_NAME
  - status_STATUS
 
-When run against a specific host, this script returns the following variables:
+The variables below are returned in the `_meta` hostvars of --list, so Ansible
+does not need to call --host for each cloudserver.  When run against a specific
+host, this script returns the following variables:
 
  - anet_cloned_from
  - anet_cu_id
@@ -146,22 +150,94 @@ import sys
 import re
 import argparse
 from time import time
-import ConfigParser
-import ast
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 try:
     import json
 except ImportError:
     import simplejson as json
 
 try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    import anetpy.manager
     from anetpy.manager import AnetManager
 except ImportError as importerror:
     sys.exit("failed=True msg='`anetpy` library required for this script'")
 
 
+def json_dumps(obj, pretty=False):
+    ''' Serializes to a JSON string, using orjson when it is installed '''
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option).decode('utf-8')
+    if pretty:
+        return json.dumps(obj, sort_keys=True, indent=2)
+    return json.dumps(obj)
+
+
+def json_dump(obj, fp, pretty=False):
+    ''' Writes JSON to a file without building the whole document as one string
+
+    The file is laid out the same whether or not orjson is installed.
+    '''
+    if orjson is None:
+        if pretty:
+            json.dump(obj, fp, sort_keys=True, indent=2, ensure_ascii=False)
+        else:
+            json.dump(obj, fp, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    elif not isinstance(obj, dict) or not obj:
+        fp.write(json_dumps(obj, pretty=pretty))
+    else:
+        # orjson has no streaming API, so write one top-level key at a time,
+        # indenting each chunk one level to sit inside the enclosing object
+        fp.write('{')
+        for i, key in enumerate(sorted(obj)):
+            if i:
+                fp.write(',')
+            if pretty:
+                fp.write('\n  ')
+            fp.write(json_dumps(key))
+            fp.write(': ' if pretty else ':')
+            chunk = json_dumps(obj[key], pretty=pretty)
+            fp.write(chunk.replace('\n', '\n  ') if pretty else chunk)
+        fp.write('\n}' if pretty else '}')
+
+
+def json_loads(text):
+    ''' Parses a JSON string, using orjson when it is installed '''
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class SessionRequests(object):
+    ''' Stands in for the `requests` module so get/post/request reuse one keep-alive Session '''
+
+    def __init__(self, session):
+        self.session = session
+
+    def __getattr__(self, name):
+        if name in ('get', 'post', 'request'):
+            return getattr(self.session, name)
+        return getattr(requests, name)
+
 
 class AtlanticNetInventory(object):
 
+    # Characters that are not allowed in Ansible group names
+    _SAFE_RE = re.compile(r'[^A-Za-z0-9\-.]')
+
     ###########################################################################
     # Main execution path
     ###########################################################################
@@ -172,6 +248,8 @@ class AtlanticNetInventory(object):
         # Atlantic.Net Inventory data
         self.data = {}      # All Atlantic.Net data
         self.inventory = {} # Ansible Inventory
+        self.indices = {}   # IP addresses by InstanceId, cloudservers by IP address
+        self.safe_words = {} # Memoized to_safe() results
 
         # Define defaults
         self.cache_path = '.'
@@ -192,22 +270,22 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
 
         # env command, show Atlantic.Net credentials
         if self.args.env:
-            print "ANET_PUBLIC_KEY=%s" % self.public_key
-            print "ANET_PRIVATE_KEY=%s" % self.private_key
+            print("ANET_PUBLIC_KEY=%s" % self.public_key)
+            print("ANET_PRIVATE_KEY=%s" % self.private_key)
             sys.exit(0)
 
         # Manage cache
-        self.cache_filename = self.cache_path + "/ansible-atlantic_net.cache"
-        self.cache_refreshed = False
+        self.cache_dir = self.cache_path + "/ansible-atlantic_net"
+        self.cache_refreshed = set()
 
-        if self.is_cache_valid:
-            self.load_from_cache()
-            if len(self.data) == 0:
-                if self.args.force_cache:
-                    sys.stderr.write('''Cache is empty and --force-cache was specified\n''')
-                    sys.exit(-1)
+        self.load_from_cache(self.cached_resources())
+        if not (self.data or self.inventory or self.indices):
+            if self.args.force_cache:
+                sys.stderr.write('''Cache is empty and --force-cache was specified\n''')
+                sys.exit(-1)
 
         self.manager = AnetManager(self.public_key, self.private_key, "2010-12-30")
+        self.share_session()
 
         # Pick the json_data to print based on the CLI command
         if self.args.cloudservers:
@@ -227,8 +305,17 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
             json_data = self.data
         elif self.args.host:
             json_data = self.load_cloudserver_variables_for_host()
+        elif self.inventory and (self.args.force_cache or
+                                 (self.is_cache_valid('inventory') and not self.args.refresh_cache)):
+            # '--list' with a warm or forced cache, the cached inventory is already the answer
+            # apart from group_variables, which may have changed in the INI since
+            self.inventory['all']['vars'] = self.group_variables
+            json_data = self.inventory
         else:    # '--list' this is last to make it default
             self.load_from_atlantic_net('cloudservers')
+            if 'cloudservers' not in self.data:
+                sys.stderr.write('''No cached cloudservers and --force-cache was specified\n''')
+                sys.exit(-1)
 
             self.build_inventory()
             json_data = self.inventory
@@ -236,10 +323,7 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
         if self.cache_refreshed:
             self.write_to_cache()
 
-        if self.args.pretty:
-            print json.dumps(json_data, sort_keys=True, indent=2)
-        else:
-            print json.dumps(json_data)
+        print(json_dumps(json_data, pretty=self.args.pretty))
         # That's all she wrote...
 
 
@@ -249,8 +333,14 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
 
     def read_settings(self):
         ''' Reads the settings from the anet_inventory.ini file '''
-        config = ConfigParser.SafeConfigParser()
-        config.read(os.path.dirname(os.path.realpath(__file__)) + '/anet_inventory.ini')
+        ini_path = os.path.dirname(os.path.realpath(__file__)) + '/anet_inventory.ini'
+        if not os.path.isfile(ini_path):
+            return
+
+        # Only pay for importing configparser when there is something to parse
+        import configparser
+        config = configparser.ConfigParser()
+        config.read(ini_path)
 
         # Credentials
         if config.has_option('atlantic_net', 'public_key'):
@@ -267,7 +357,13 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
 
         # Group variables
         if config.has_option('atlantic_net', 'group_variables'):
-            self.group_variables = ast.literal_eval(config.get('atlantic_net', 'group_variables'))
+            try:
+                self.group_variables = json_loads(config.get('atlantic_net', 'group_variables'))
+            except ValueError:
+                self.group_variables = None
+            if not isinstance(self.group_variables, dict):
+                sys.stderr.write('''group_variables must be a JSON object, e.g. { "ansible_user": "root" }\n''')
+                sys.exit(-1)
 
     def read_environment(self):
         ''' Reads the settings from environment variables '''
@@ -326,24 +422,43 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
         if self.args.force_cache:
             return
         # We always get fresh cloudservers
-        if self.is_cache_valid() and not (resource == 'cloudservers' or resource is None):
+        if resource not in ('cloudservers', None) and resource in self.data and self.is_cache_valid(resource):
             return
         if self.args.refresh_cache:
             resource = None
 
-        if resource == 'cloudservers' or resource is None:
-            self.data['cloudservers'] = self.manager.all_active_cloudservers()
-            self.cache_refreshed = True
-        if resource == 'images' or resource is None:
-            #self.data['images'] = self.manager.all_images(filter=None)
-            self.data['images'] = self.manager.all_images()
-            self.cache_refreshed = True
-        if resource == 'plans' or resource is None:
-            self.data['plans'] = self.manager.plans()
-            self.cache_refreshed = True
-        if resource == 'ssh-keys' or resource is None:
-            self.data['ssh-keys'] = self.manager.all_ssh_keys()
-            self.cache_refreshed = True
+        fetchers = {
+            'cloudservers': self.manager.all_active_cloudservers,
+            'images': self.manager.all_images,
+            'plans': self.manager.plans,
+            'ssh-keys': self.manager.all_ssh_keys,
+        }
+        if resource is not None:
+            fetchers = {resource: fetchers[resource]}
+
+        # The requests are independent, so fetch them side by side
+        if len(fetchers) > 1:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = dict((name, executor.submit(fetch)) for name, fetch in fetchers.items())
+            for name, future in futures.items():
+                self.data[name] = future.result()
+        else:
+            for name, fetch in fetchers.items():
+                self.data[name] = fetch()
+        self.cache_refreshed.update(fetchers)
+
+    def share_session(self):
+        ''' Sends every AnetManager API call through a single keep-alive requests.Session '''
+        # This relies on anetpy calling requests.get/post/request at module level;
+        # swapping its `requests` reference routes those calls through the session
+        if requests is None or getattr(anetpy.manager, 'requests', None) is not requests:
+            sys.stderr.write('''anetpy.manager does not use the requests module, '''
+                             '''API calls will not share a keep-alive session\n''')
+            return
+
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=10))
+        anetpy.manager.requests = SessionRequests(session)
 
     def build_inventory(self):
         '''Build Ansible inventory of cloudservers'''
@@ -354,57 +469,77 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
                                    },
                             '_meta': {'hostvars':{}}
                         }
+        groups = defaultdict(lambda: {'hosts':[], 'vars': {}})
+        self.indices = {'by_id': {}, 'by_ip': {}}
+
+        # Bind what the loop touches to locals to save attribute lookups
+        append_host = self.inventory['all']['hosts'].append
+        hostvars = self.inventory['_meta']['hostvars']
+        by_id = self.indices['by_id']
+        by_ip = self.indices['by_ip']
+        anet_variables = self.anet_variables
+        to_safe = self.to_safe
 
         # add all cloudservers by id and name
         for k, cloudserver in self.data['cloudservers'].items():
             dest = cloudserver['vm_ip_address']
 
-            self.inventory['all']['hosts'].append(dest)
+            append_host(dest)
+
+            # Ansible never has to call --host for each cloudserver
+            hostvars[dest] = anet_variables(cloudserver)
+
+            # Let --host find the cloudserver in the cache by ID or IP address
+            by_id[str(cloudserver['InstanceId'])] = dest
+            by_ip[dest] = cloudserver
 
             #self.inventory[cloudserver['InstanceId']] = dest
             #self.inventory[cloudserver['vm_description']] = dest
 
+            image = cloudserver['vm_image']
+            image_lower = image.lower()
+
             # groups that are always present
-            for group in [
-                            'image_' + self.to_safe(cloudserver['vm_image']),
+            for group in (
+                            'image_' + to_safe(image),
                             'plan_' + cloudserver['vm_plan_name'],
-                            'distro_' + self.to_safe(cloudserver['vm_image_display_name']),
+                            'distro_' + to_safe(cloudserver['vm_image_display_name']),
                             'status_' + cloudserver['vm_status']
-                        ]:
-                if group not in self.inventory:
-                    self.inventory[group] = {'hosts':[], 'vars': {}}
-                self.inventory[group]['hosts'].append(dest)
-
-            if 'debian' in cloudserver['vm_image'].lower():
-                if 'Debian' not in self.inventory:
-                    self.inventory['Debian'] = {'hosts':[], 'vars': {}}
-                self.inventory['Debian']['hosts'].append(dest)
-            if 'centos' in cloudserver['vm_image'].lower():
-                if 'Centos' not in self.inventory:
-                    self.inventory['Centos'] = {'hosts':[], 'vars': {}}
-                self.inventory['Centos']['hosts'].append(dest)
-            if 'pfsense' in cloudserver['vm_image'].lower():
-                if 'pfSense' not in self.inventory:
-                    self.inventory['pfSense'] = {'hosts':[], 'vars': {}}
-                self.inventory['pfSense']['hosts'].append(dest)
-            if 'windows' in cloudserver['vm_image'].lower():
-                if 'Windows' not in self.inventory:
-                    self.inventory['Windows'] = {'hosts':[], 'vars': {}}
-                self.inventory['Windows']['hosts'].append(dest)
+                        ):
+                groups[group]['hosts'].append(dest)
+
+            if 'debian' in image_lower:
+                groups['Debian']['hosts'].append(dest)
+            if 'centos' in image_lower:
+                groups['Centos']['hosts'].append(dest)
+            if 'pfsense' in image_lower:
+                groups['pfSense']['hosts'].append(dest)
+            if 'windows' in image_lower:
+                groups['Windows']['hosts'].append(dest)
+
+        self.inventory.update(groups)
+        self.cache_refreshed.update(('inventory', 'indices'))
 
     def load_cloudserver_variables_for_host(self):
         '''Generate a JSON response to a --host call'''
-        host = int(self.args.host)
-
-        cloudserver = self.manager.show_cloudserver(host)
+        # Prefer the cloudserver indexed in the cache over an API call
+        ip_address = self.indices.get('by_id', {}).get(self.args.host, self.args.host)
+        cloudserver = self.indices.get('by_ip', {}).get(ip_address)
+        if cloudserver is not None:
+            return self.anet_variables(cloudserver)
+
+        # Ansible names hosts by IP address, which show_cloudserver cannot take
+        if not self.args.host.isdigit():
+            for k, cloudserver in self.manager.all_active_cloudservers().items():
+                if cloudserver['vm_ip_address'] == self.args.host:
+                    return self.anet_variables(cloudserver)
+            return {}
 
-        # Put all the information in a 'anet_' namespace
         info = {}
-        for k, v in cloudserver.items():
-            for l, w in v.items():
-                info['anet_'+l] = w
+        for k, v in self.manager.show_cloudserver(int(self.args.host)).items():
+            info.update(self.anet_variables(v))
 
-        return {'cloudserver': info}
+        return info
 
 
 
@@ -412,38 +547,94 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
     # Cache Management
     ###########################################################################
 
-    def is_cache_valid(self):
-        ''' Determines if the cache files have expired, or if it is still valid '''
-        if os.path.isfile(self.cache_filename):
-            mod_time = os.path.getmtime(self.cache_filename)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                return True
-        return False
+    def cache_filename(self, name):
+        ''' Path of the cache file holding one resource, the inventory or the indices '''
+        return self.cache_dir + '/' + name + '.json'
 
 
-    def load_from_cache(self):
-        ''' Reads the data from the cache file and assigns it to member variables as Python Objects'''
-        try:
-            cache = open(self.cache_filename, 'r')
-            json_data = cache.read()
-            cache.close()
-            data = json.loads(json_data)
-        except IOError:
-            data = {'data': {}, 'inventory': {}}
+    def cached_resources(self):
+        ''' The cache files needed to answer the current CLI command '''
+        if self.args.cloudservers:
+            return ['cloudservers']
+        elif self.args.images:
+            return ['images']
+        elif self.args.plans:
+            return ['plans']
+        elif self.args.ssh_keys:
+            return ['ssh-keys']
+        elif self.args.all:
+            return ['cloudservers', 'images', 'plans', 'ssh-keys']
+        elif self.args.host:
+            return ['indices']
+        elif self.args.force_cache:
+            # Rebuild the inventory from the cached cloudservers if it is missing
+            return ['inventory', 'cloudservers']
+        return ['inventory']
 
-        self.data = data['data']
-        self.inventory = data['inventory']
 
+    def is_cache_valid(self, name):
+        ''' Determines if a cache file has expired, or if it is still valid '''
+        try:
+            mod_time = os.stat(self.cache_filename(name)).st_mtime
+        except OSError:
+            return False
+        return (mod_time + self.cache_max_age) > time()
+
+
+    def load_from_cache(self, names):
+        ''' Reads the named cache files and assigns them to member variables as Python Objects'''
+        for name in names:
+            if not (self.args.force_cache or self.is_cache_valid(name)):
+                continue
+            # A file caught mid-replace by another worker is retried once
+            for attempt in range(2):
+                try:
+                    with open(self.cache_filename(name), 'r', encoding='utf-8') as cache:
+                        json_data = cache.read()
+                    data = json_loads(json_data)
+                    break
+                except IOError:
+                    data = None
+                    break
+                except ValueError:
+                    data = None
+            if data is None:
+                continue
+
+            if name == 'inventory':
+                self.inventory = data
+            elif name == 'indices':
+                self.indices = data
+            else:
+                self.data[name] = data
 
-    def write_to_cache(self):
-        ''' Writes data in JSON format to a file '''
-        data = {'data': self.data, 'inventory': self.inventory}
-        json_data = json.dumps(data, sort_keys=True, indent=2)
 
-        cache = open(self.cache_filename, 'w')
-        cache.write(json_data)
-        cache.close()
+    def write_to_cache(self):
+        ''' Writes the refreshed resources in JSON format, one file each '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        for name in self.cache_refreshed:
+            if name == 'inventory':
+                data = self.inventory
+            elif name == 'indices':
+                data = self.indices
+            else:
+                data = self.data[name]
+
+            # Write beside the cache file and rename it into place so concurrent
+            # Ansible workers never read a partially written file
+            filename = self.cache_filename(name)
+            tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+            try:
+                with open(tmp_filename, 'w', encoding='utf-8') as cache:
+                    json_dump(data, cache, pretty=True)
+                    cache.flush()
+                    os.fsync(cache.fileno())
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                if os.path.exists(tmp_filename):
+                    os.unlink(tmp_filename)
+                raise
 
 
     ###########################################################################
@@ -458,9 +649,22 @@ or environment variables (ANET_PUBLIC_KEY and ANET_PRIVATE_KEY)\n''')
             my_dict[key] = [element]
 
 
+    def anet_variables(self, cloudserver):
+        ''' Puts all the information about a cloudserver in a 'anet_' namespace '''
+        info = {}
+        for k, v in cloudserver.items():
+            info['anet_'+k] = v
+        return info
+
+
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be used as Ansible groups '''
-        return re.sub("[^A-Za-z0-9\-\.]", "_", word)
+        # Image and plan names repeat across cloudservers, so remember the results
+        try:
+            return self.safe_words[word]
+        except KeyError:
+            safe = self.safe_words[word] = self._SAFE_RE.sub('_', word)
+            return safe
 
 
 